@@ -1,7 +1,10 @@
 import os
 import sqlite3
+import threading
+from contextlib import closing, contextmanager
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string
+import orjson
+from flask import Flask, request, render_template_string
 
 # -----------------------------
 # App config
@@ -21,60 +24,118 @@ if os.name != "nt":  # not Windows
     default_db = "/tmp/chat.db"
 
 DB_PATH = os.environ.get("DB_PATH", default_db)
+# -----------------------------
+# SQL
+# -----------------------------
+# Kept as module-level constants so every call passes the identical string
+# and hits sqlite3's prepared-statement cache instead of re-parsing.
+SQL_CREATE_MESSAGES = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+"""
+
+# fetch_messages: WHERE session_id = ? ORDER BY id DESC LIMIT ?
+SQL_CREATE_INDEX_SESSION_ID = "CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id DESC)"
+
+# list_sessions: GROUP BY session_id + MAX(created_at), answered from the index
+SQL_CREATE_INDEX_SESSION_CREATED = "CREATE INDEX IF NOT EXISTS idx_messages_session_created ON messages(session_id, created_at DESC)"
+
+SQL_INSERT_MESSAGE = "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)"
+
+SQL_FETCH_MESSAGES = "SELECT id, role, content, created_at FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?"
+
+SQL_LIST_SESSIONS = """
+    SELECT session_id, MAX(created_at) AS last_time, COUNT(*) AS msg_count
+    FROM messages
+    GROUP BY session_id
+    ORDER BY last_time DESC
+    LIMIT ?
+"""
+
 # -----------------------------
 # DB helpers
 # -----------------------------
+# One connection per worker process, shared by all request threads.
+# Helpers that take `conn` never commit: the route handler opens the
+# transaction (BEGIN IMMEDIATE) and ends it exactly once.
+_db_lock = threading.Lock()
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # Call only while holding _db_lock (use db() below).
+    conn = app.extensions.get("sqlite_conn")
+    if conn is None:
+        # isolation_level=None: autocommit, transactions are opened explicitly
+        conn = sqlite3.connect(
+            DB_PATH,
+            cached_statements=256,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        conn.row_factory = sqlite3.Row
+        # safe with WAL; fsync only at checkpoints instead of on every commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # the connection lives as long as the worker, so a big page cache
+        # stays warm: ~20MB cache, temp tables in RAM, 256MB mmap window
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        app.extensions["sqlite_conn"] = conn
     return conn
 
+@contextmanager
+def db():
+    # sqlite3 connections must not be used by two threads at once
+    with _db_lock:
+        yield get_conn()
+
 def init_db():
     # Ensure parent dir exists (for custom DB_PATH)
     parent = os.path.dirname(DB_PATH)
     if parent and not os.path.exists(parent):
         os.makedirs(parent, exist_ok=True)
 
-    with get_conn() as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        """)
-        conn.commit()
-
-
-def add_message(session_id: str, role: str, content: str):
-    with get_conn() as conn:
-        conn.execute(
-            "INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-            (session_id, role, content, datetime.utcnow().isoformat())
-        )
-        conn.commit()
-
-def fetch_messages(session_id: str, limit: int = 50):
-    with get_conn() as conn:
-        rows = conn.execute(
-            "SELECT id, session_id, role, content, created_at FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
-            (session_id, limit)
-        ).fetchall()
+    # Short-lived connection of its own: init_db runs at import, possibly in
+    # a parent that forks workers afterwards (gunicorn --preload, uWSGI), and
+    # an SQLite handle must not cross fork(). The shared connection is
+    # created lazily by get_conn() on the first request in each worker.
+    with closing(sqlite3.connect(DB_PATH, isolation_level=None)) as conn:
+        # journal_mode is persistent, so setting it once here is enough
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(SQL_CREATE_MESSAGES)
+        conn.execute(SQL_CREATE_INDEX_SESSION_ID)
+        conn.execute(SQL_CREATE_INDEX_SESSION_CREATED)
+
+
+def add_messages(conn, session_id: str, items):
+    """
+    items: [(role, content), ...] inserted in order with one executemany
+    """
+    ts = datetime.utcnow().isoformat()
+    conn.executemany(
+        SQL_INSERT_MESSAGE,
+        [(session_id, role, content, ts) for role, content in items]
+    )
+
+def add_message(conn, session_id: str, role: str, content: str):
+    add_messages(conn, session_id, [(role, content)])
+
+def fetch_messages(conn, session_id: str, limit: int = 50):
+    rows = conn.execute(SQL_FETCH_MESSAGES, (session_id, limit)).fetchall()
     return list(reversed(rows))
 
-def list_sessions(limit: int = 20):
-    with get_conn() as conn:
-        rows = conn.execute("""
-            SELECT session_id, MAX(created_at) AS last_time, COUNT(*) AS msg_count
-            FROM messages
-            GROUP BY session_id
-            ORDER BY last_time DESC
-            LIMIT ?
-        """, (limit,)).fetchall()
+def list_sessions(conn, limit: int = 20):
+    rows = conn.execute(SQL_LIST_SESSIONS, (limit,)).fetchall()
     return rows
 
+# Schema setup runs once per worker at import time (also under gunicorn /
+# Cloud Run, where __main__ is never executed), not on every request.
+init_db()
+
 # -----------------------------
 # Bot logic (rule-based)
 # -----------------------------
@@ -313,6 +374,9 @@ INDEX_HTML = """
 # -----------------------------
 # Routes
 # -----------------------------
+def ojson(obj, status=200):
+    # orjson encodes in C and emits compact UTF-8 (no ASCII escaping)
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
 
 @app.get("/")
 def index():
@@ -324,64 +388,52 @@ def healthz():
 
 @app.get("/api/sessions")
 def api_sessions():
-    init_db()
-    sessions = list_sessions(limit=50)
-    return jsonify({
-        "sessions": [
-            {
-                "session_id": r["session_id"],
-                "last_time": r["last_time"],
-                "msg_count": r["msg_count"]
-            } for r in sessions
-        ]
-    })
+    with db() as conn:
+        sessions = list_sessions(conn, limit=50)
+    # SQL column names are the API keys
+    return ojson({"sessions": [dict(r) for r in sessions]})
 
 @app.get("/api/history")
 def api_history():
-    init_db()
     session_id = request.args.get("session_id", "").strip()
     if not session_id:
-        return jsonify({"error": "session_id is required"}), 400
-    rows = fetch_messages(session_id, limit=200)
-    return jsonify({
+        return ojson({"error": "session_id is required"}, 400)
+    with db() as conn:
+        rows = fetch_messages(conn, session_id, limit=200)
+    return ojson({
         "session_id": session_id,
-        "messages": [
-            {
-                "id": r["id"],
-                "role": r["role"],
-                "content": r["content"],
-                "created_at": r["created_at"]
-            } for r in rows
-        ]
+        "messages": [dict(r) for r in rows]
     })
 
 @app.post("/api/chat")
 def api_chat():
-    init_db()
     data = request.get_json(silent=True) or {}
     session_id = (data.get("session_id") or "").strip()
     message = (data.get("message") or "").strip()
 
     if not session_id:
-        return jsonify({"error": "session_id is required"}), 400
+        return ojson({"error": "session_id is required"}, 400)
     if not message:
-        return jsonify({"error": "message is required"}), 400
+        return ojson({"error": "message is required"}, 400)
 
-    # Store user message
-    add_message(session_id, "user", message)
+    # One write transaction for the whole exchange: the reply is generated
+    # first so both messages go in with a single executemany and commit.
+    with db() as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
 
-    # Generate reply using history
-    history = fetch_messages(session_id, limit=50)
-    reply = generate_reply(message, history)
+        # Generate reply using history (+ the message being sent, which is
+        # not stored yet)
+        history = fetch_messages(conn, session_id, limit=49)
+        history.append({"role": "user", "content": message})
+        reply = generate_reply(message, history)
 
-    # Store assistant message
-    add_message(session_id, "assistant", reply)
+        # Store user + assistant messages
+        add_messages(conn, session_id, [("user", message), ("assistant", reply)])
 
-    return jsonify({"ok": True, "reply": reply})
+    return ojson({"ok": True, "reply": reply})
 
 # -----------------------------
 # Entry
 # -----------------------------
 if __name__ == "__main__":
-    init_db()
     app.run(host="0.0.0.0", port=PORT, debug=True)